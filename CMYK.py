@@ -1,9 +1,18 @@
 import customtkinter as ctk
+from array import array
 from PIL import Image
+import numpy as np
 from tkinter import filedialog, messagebox
+from functools import lru_cache
+import mmap
 import os
+import queue
 import re
 import sys
+import tempfile
+import threading
+
+import gcode_modify
 
 
 def resource_path(relative_path):
@@ -17,119 +26,98 @@ def resource_path(relative_path):
     return os.path.join(base_path, relative_path)
 
 
+def read_gcode_blocks(f, size=1 << 20):
+    """Yield the text of a file in blocks of up to size characters."""
+    block = f.read(size)
+    while block:
+        yield block
+        block = f.read(size)
+
+
 class GCodeToolSwitcher:
     def __init__(self, tool_names, tool_change_commands):
         self.layer_markers = ";LAYER_CHANGE"
+        # Layer markers start a line; MULTILINE lets one scan over a block of text find all of them
+        self.layer_pattern = re.compile('^' + re.escape(self.layer_markers), re.MULTILINE)
         self.tool_change_commands = tool_change_commands
         self.tool_names = tool_names
-        self.m104_pattern = re.compile(r'M104\.1\s+T(\d+)')
-        self.tool_pattern = re.compile(r'\bT(\d+)\s+S\d+\s+L\d+\s+D\d+')
-        self.simple_tool_pattern = re.compile(r'^T(\d+)\s*;')
-        self.park_pattern = re.compile(r'P0\s+S1\s+L2\s+D0')
-        self.pickup_pattern = re.compile(r'T(\d+)\s+S1\s+L0\s+D0')
-
-    def parse_layers(self, gcode_content):
-        """Parse G-code content and identify layer positions."""
-        layers = []
-        lines = gcode_content.split('\n')
-        for i, line in enumerate(lines):
-            if self.layer_markers in line:
-                layers.append(i)
-        return layers, lines
+        # One alternation for every tool command we rewrite; each named group is
+        # followed by the group capturing its tool number, so a line is scanned once.
+        # A pickup is the tool form with S1 L0 D0, told apart by the captured values.
+        self.combined_pattern = re.compile(
+            r'(?P<park>P0\s+S1\s+L2\s+D0)'
+            r'|(?P<m104>M104\.1\s+T(\d+))'
+            r'|(?P<tool>\bT(\d+)\s+S(\d+)\s+L(\d+)\s+D(\d+))'
+            r'|(?P<simple>^T(\d+)\s*;)',
+            re.MULTILINE)
+        # Every tool command above holds a T<n> or the park's P0, so a layer without either is left as is
+        self.tool_hint_pattern = re.compile(r'T\d|P0\s')
+        # Tool commands only appear on lines starting with one of these; plain moves skip the regex
+        self.command_starts = ('T', 'M', 'P', ';', ' ', '\t')
+        self.p_pattern = re.compile(r'P(\d+)')
+        self.q_pattern = re.compile(r'Q(\d+)')
+        self.s_pattern = re.compile(r'S(\d+)')
+        self.comment_pattern = re.compile(r';.*$')
 
     def calculate_tool_distribution(self, total_layers, ratio_pattern):
         """Calculate which tool to use for each layer based on sequential layer-by-layer printing."""
-        tool_sequence = []
-        while len(tool_sequence) < total_layers:
-            for tool_idx, count in enumerate(ratio_pattern):
-                for _ in range(int(count)):
-                    if len(tool_sequence) < total_layers:
-                        tool_sequence.append(tool_idx)
-                    else:
-                        break
-                if count % 1 > 0 and len(tool_sequence) < total_layers:
-                    tool_sequence.append(tool_idx)
-                if len(tool_sequence) >= total_layers:
-                    break
-        return tool_sequence
-
-    def modify_gcode(self, gcode_lines, layer_positions, tool_sequence):
-        """Modify G-code to update tool commands with appropriate tool numbers."""
-        modified_gcode = gcode_lines.copy()
-        current_layer = -1
-        current_tool = None
-        active_tool = None  # Track which tool is currently active
-        for i, line in enumerate(modified_gcode):
-            if i in layer_positions:
-                current_layer += 1
-                if current_layer < len(tool_sequence):
-                    current_tool = tool_sequence[current_layer]
-            if current_tool is not None:
-                park_match = self.park_pattern.search(line)
-                if park_match and active_tool == current_tool:
-                    modified_gcode[
-                        i] = f"; {line} - skipped parking as T{current_tool} ({self.tool_names[current_tool]}) is already active"
-                    continue
-                pickup_match = self.pickup_pattern.search(line)
-                if pickup_match:
-                    tool_to_pickup = int(pickup_match.group(1))
-                    if tool_to_pickup != current_tool:
-                        modified_gcode[i] = re.sub(r'T\d+', f'T{current_tool}', line)
-                        active_tool = current_tool
-                    elif active_tool == current_tool:
-                        modified_gcode[
-                            i] = f"; {line} - skipped pickup as T{current_tool} ({self.tool_names[current_tool]}) is already active"
-                        continue
-                    else:
-                        active_tool = current_tool
-                m104_match = self.m104_pattern.search(line)
-                if m104_match:
-                    old_tool = int(m104_match.group(1))
-                    if old_tool != current_tool:
-                        if active_tool != current_tool:
-                            p_match = re.search(r'P(\d+)', line)
-                            q_match = re.search(r'Q(\d+)', line)
-                            s_match = re.search(r'S(\d+)', line)
-                            p_value = p_match.group(1) if p_match else "120"
-                            q_value = q_match.group(1) if q_match else str(int(p_value) + current_tool + 1)
-                            s_value = s_match.group(1) if s_match else "210"
-                            new_command = f"M104.1 T{current_tool} P{p_value} Q{q_value} S{s_value}"
-                            comment_match = re.search(r';.*$', line)
-                            if comment_match:
-                                new_command += f" {comment_match.group(0)}"
-                            else:
-                                new_command += f" ; switched from T{old_tool} ({self.tool_names[old_tool]}) to T{current_tool} ({self.tool_names[current_tool]})"
-                            modified_gcode[i] = new_command
-                            active_tool = current_tool
-                        else:
-                            modified_gcode[
-                                i] = f"; {line} - skipped as T{current_tool} ({self.tool_names[current_tool]}) is already active"
-                            continue
-                tool_match = self.tool_pattern.search(line)
-                if tool_match:
-                    old_tool = int(tool_match.group(1))
-                    if old_tool != current_tool:
-                        new_line = re.sub(r'\bT\d+\b', f'T{current_tool}', line)
-                        modified_gcode[i] = new_line
-                        active_tool = current_tool
-                simple_match = self.simple_tool_pattern.search(line)
-                if simple_match:
-                    old_tool = int(simple_match.group(1))
-                    if old_tool != current_tool:
-                        new_line = re.sub(r'^T\d+', f'T{current_tool}', line)
-                        modified_gcode[i] = new_line
-                        active_tool = current_tool
-        return modified_gcode
-
-    def process_file(self, input_file, output_file, ratio_pattern):
-        with open(input_file, 'r') as f:
-            gcode_content = f.read()
-        layer_positions, gcode_lines = self.parse_layers(gcode_content)
-        total_layers = len(layer_positions)
+        if total_layers <= 0:
+            return array('B')
+        # A fractional count rounds up: the partial layer is printed as a whole one. No tool can
+        # print more layers than the file has, so huge counts are capped before the block is built.
+        counts = [min(max(int(count), 0) + (1 if count % 1 > 0 else 0), total_layers) for count in ratio_pattern]
+        block = np.repeat(np.arange(len(counts)), counts)
+        if block.size == 0:
+            return array('B')
+        repeats = -(-total_layers // block.size)
+        # One byte per layer is plenty for the tool index and keeps long prints compact
+        return array('B', np.tile(block, repeats)[:total_layers].astype(np.uint8).tobytes())
+
+    def modify_gcode_iter(self, gcode_blocks, tool_sequence):
+        """Yield the modified G-code as text one layer at a time, ready to be written out in order."""
+        return gcode_modify.modify_layers(self, gcode_blocks, tool_sequence)
+
+    def count_layers(self, input_file):
+        """Count the layer markers in a G-code file by searching a memory map of it."""
+        marker = self.layer_markers.encode()
+        with open(input_file, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return 0
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                count = 1 if mm[:len(marker)] == marker else 0
+                # The rewrite pass reads in universal-newline mode, so a line may end in \n, \r\n or a lone \r;
+                # \r\n is found through its \n, and \r followed directly by the marker is a lone \r
+                for line_marker in (b'\n' + marker, b'\r' + marker):
+                    pos = mm.find(line_marker)
+                    while pos != -1:
+                        count += 1
+                        pos = mm.find(line_marker, pos + 1)
+        return count
+
+    def process_file(self, input_file, output_file, ratio_pattern, log=None):
+        total_layers = self.count_layers(input_file)
+        if log:
+            log(f"Found {total_layers} layers, writing output...\n")
         tool_sequence = self.calculate_tool_distribution(total_layers, ratio_pattern)
-        modified_lines = self.modify_gcode(gcode_lines, layer_positions, tool_sequence)
-        with open(output_file, 'w') as f:
-            f.write('\n'.join(modified_lines))
+        # Stream the file one layer at a time so memory use does not grow with the file size. The output goes
+        # to a temporary file first, so the input may also be the output and a failure leaves the old file alone.
+        f_out = tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(output_file)),
+                                            suffix='.gcode', delete=False, buffering=1 << 20)
+        try:
+            with f_out, open(input_file, 'r') as f_in:
+                f_out.writelines(self.modify_gcode_iter(read_gcode_blocks(f_in), tool_sequence))
+            if os.path.exists(output_file):
+                mode = os.stat(output_file).st_mode
+            else:
+                # A new file gets the permissions open() would have given it; os.umask can only be read by setting it
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o666 & ~umask
+            os.chmod(f_out.name, mode)
+            os.replace(f_out.name, output_file)
+        except BaseException:
+            os.remove(f_out.name)
+            raise
         return total_layers, tool_sequence
 
 
@@ -142,6 +130,8 @@ class App(ctk.CTk):
         self.tool_switcher = tool_switcher
         self.ratio_pattern = default_ratio
         self.tool_names_ui = tool_names_ui
+        self.worker = None
+        self.protocol("WM_DELETE_WINDOW", self.on_close)
 
         # Initialize the tabview
         self.tabview = ctk.CTkTabview(self)
@@ -214,8 +204,8 @@ class App(ctk.CTk):
         process_frame = ctk.CTkFrame(main_frame)
         process_frame.pack(fill="x", padx=10, pady=10)
 
-        ctk.CTkButton(process_frame, text="Process G-code", command=self.process_gcode).pack(
-            side=ctk.RIGHT, padx=5)
+        self.process_button = ctk.CTkButton(process_frame, text="Process G-code", command=self.process_gcode)
+        self.process_button.pack(side=ctk.RIGHT, padx=5)
 
         # Status and log section
         log_frame = ctk.CTkFrame(main_frame)
@@ -274,73 +264,108 @@ class App(ctk.CTk):
         if sum(pattern) <= 0:
             messagebox.showerror("Error", "At least one tool must have a value greater than zero")
             return
-        try:
-            self.log_text.delete(1.0, ctk.END)
-            self.log_text.insert(ctk.END, f"Processing file: {input_file}\n")
-            self.log_text.insert(ctk.END, f"Output file: {output_file}\n")
-            tool_pattern_string = ", ".join([f"{name}:{count}" for name, count in zip(self.tool_names_ui, pattern)])
-            self.log_text.insert(ctk.END, f"Using tool ratio pattern: {tool_pattern_string}\n")
-            self.log_text.update()
-            total_layers, tool_sequence = self.tool_switcher.process_file(input_file, output_file, pattern)
-            self.log_text.insert(ctk.END, f"\nProcessing complete!\n")
-            self.log_text.insert(ctk.END, f"Total layers: {total_layers}\n\n")
-            tool_counts = [0] * len(self.tool_names_ui)
-            for tool in tool_sequence:
-                tool_counts[tool] += 1
-            for i, (count, name) in enumerate(zip(tool_counts, self.tool_names_ui)):
-                if count > 0:
-                    self.log_text.insert(ctk.END,
-                                         f"Tool {i} ({name}) used for {count} layers ({count / total_layers * 100:.1f}%)\n")
-            if total_layers > 0:
-                display_count = min(20, total_layers)
-                self.log_text.insert(ctk.END, f"\nFirst {display_count} layers tool sequence:\n")
-                for i in range(display_count):
-                    tool_num = tool_sequence[i]
-                    self.log_text.insert(ctk.END, f"Layer {i + 1}: Tool {tool_num} ({self.tool_names_ui[tool_num]})\n")
-            messagebox.showinfo("Success", f"G-code processed successfully!\n{total_layers} layers modified.")
-        except Exception as e:
-            self.log_text.insert(ctk.END, f"\nError: {str(e)}\n")
-            messagebox.showerror("Error", f"Failed to process G-code: {str(e)}")
+        self.log_text.delete(1.0, ctk.END)
+        self.log_text.insert(ctk.END, f"Processing file: {input_file}\n")
+        self.log_text.insert(ctk.END, f"Output file: {output_file}\n")
+        tool_pattern_string = ", ".join([f"{name}:{count}" for name, count in zip(self.tool_names_ui, pattern)])
+        self.log_text.insert(ctk.END, f"Using tool ratio pattern: {tool_pattern_string}\n")
+        self.process_button.configure(state="disabled")
 
-    def hex_to_rgb(self, hex_value):
+        # Run the switcher off the Tk thread so the window stays responsive; results come back through the queue
+        messages = queue.Queue()
+
+        def worker():
+            try:
+                result = self.tool_switcher.process_file(
+                    input_file, output_file, pattern, log=lambda text: messages.put(("log", text)))
+                messages.put(("done", result))
+            except Exception as e:
+                messages.put(("error", e))
+
+        # Not a daemon thread: if the window is closed mid-run, Python still lets process_file finish
+        # and move its temporary file into place (or remove it) before exiting
+        self.worker = threading.Thread(target=worker)
+        self.worker.start()
+        self.after(50, self.drain_messages, messages)
+
+    def on_close(self):
+        """Close the window, asking first if G-code is still being processed."""
+        if self.worker is not None and self.worker.is_alive():
+            if not messagebox.askokcancel(
+                    "Processing", "G-code is still being processed. Close the window and let it finish first?"):
+                return
+        self.destroy()
+
+    def drain_messages(self, messages):
+        """Show messages from the processing thread, polling again until it has finished."""
+        while True:
+            try:
+                kind, value = messages.get_nowait()
+            except queue.Empty:
+                self.after(50, self.drain_messages, messages)
+                return
+            if kind == "log":
+                self.log_text.insert(ctk.END, value)
+            elif kind == "done":
+                self.process_button.configure(state="normal")
+                self.show_results(*value)
+                return
+            else:
+                self.process_button.configure(state="normal")
+                self.log_text.insert(ctk.END, f"\nError: {str(value)}\n")
+                messagebox.showerror("Error", f"Failed to process G-code: {str(value)}")
+                return
+
+    def show_results(self, total_layers, tool_sequence):
+        self.log_text.insert(ctk.END, f"\nProcessing complete!\n")
+        self.log_text.insert(ctk.END, f"Total layers: {total_layers}\n\n")
+        tool_counts = [0] * len(self.tool_names_ui)
+        for tool in tool_sequence:
+            tool_counts[tool] += 1
+        for i, (count, name) in enumerate(zip(tool_counts, self.tool_names_ui)):
+            if count > 0:
+                self.log_text.insert(ctk.END,
+                                     f"Tool {i} ({name}) used for {count} layers ({count / total_layers * 100:.1f}%)\n")
+        if total_layers > 0:
+            display_count = min(20, total_layers)
+            self.log_text.insert(ctk.END, f"\nFirst {display_count} layers tool sequence:\n")
+            for i in range(display_count):
+                tool_num = tool_sequence[i]
+                self.log_text.insert(ctk.END, f"Layer {i + 1}: Tool {tool_num} ({self.tool_names_ui[tool_num]})\n")
+        messagebox.showinfo("Success", f"G-code processed successfully!\n{total_layers} layers modified.")
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def hex_to_rgb(hex_value):
         """Convert hex to RGB"""
-        hex_value = hex_value.lstrip('#')
-        return tuple(int(hex_value[i:i + 2], 16) for i in (0, 2, 4))
+        return tuple(bytes.fromhex(hex_value.lstrip('#')[:6]))
 
-    def rgb_to_hex(self, r, g, b):
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def rgb_to_hex(r, g, b):
         """Convert RGB to hex"""
         return "#{:02x}{:02x}{:02x}".format(r, g, b)
 
     def mix_colors(self, colors, weights):
         """Mix colors based on weighted contributions"""
-        total_weight = sum(weights)
-        r_mix = g_mix = b_mix = 0
-
-        for i in range(len(colors)):
-            r, g, b = self.hex_to_rgb(colors[i])
-            r_mix += r * weights[i]
-            g_mix += g * weights[i]
-            b_mix += b * weights[i]
-
-        r_mix = int(r_mix / total_weight)
-        g_mix = int(g_mix / total_weight)
-        b_mix = int(b_mix / total_weight)
+        rgb = np.array([self.hex_to_rgb(color) for color in colors], dtype=np.float64)
+        weights = np.asarray(weights, dtype=np.float64)
+        r_mix, g_mix, b_mix = (int(value) for value in weights @ rgb / weights.sum())
 
         return self.rgb_to_hex(r_mix, g_mix, b_mix), r_mix, g_mix, b_mix
 
     def rgb_to_cmyk(self, r, g, b):
         """Convert RGB to CMYK"""
-        r, g, b = r / 255.0, g / 255.0, b / 255.0
-        k = min(1 - r, 1 - g, 1 - b)
+        rgb = np.array([r, g, b], dtype=np.float64) / 255.0
+        k = 1 - rgb.max()
 
         if k == 1:
-            c = m = y = 0
+            cmy = np.zeros(3)
         else:
-            c = (1 - r - k) / (1 - k)
-            m = (1 - g - k) / (1 - k)
-            y = (1 - b - k) / (1 - k)
+            cmy = (1 - rgb - k) / (1 - k)
 
-        return round(c * 100), round(m * 100), round(y * 100), round(k * 100)
+        c, m, y = (int(value) for value in np.round(cmy * 100))
+        return c, m, y, round(float(k) * 100)
 
     def apply_mixed_color(self):
         """Apply the mixed color and display CMYK values"""
@@ -0,0 +1,117 @@
+"""Tool command rewriting for GCodeToolSwitcher, one layer of G-code at a time."""
+
+
+def modify_range(switcher, gcode_lines, start, end, current_tool, active_tool):
+    """Rewrite the tool commands in gcode_lines[start:end] for current_tool and return the active tool."""
+    # Bind the switcher's attributes to locals once; the loop below runs for every line of the layer
+    tool_names = switcher.tool_names
+    command_starts = switcher.command_starts
+    find_commands = switcher.combined_pattern.finditer
+    p_search = switcher.p_pattern.search
+    q_search = switcher.q_pattern.search
+    s_search = switcher.s_pattern.search
+    comment_search = switcher.comment_pattern.search
+    tool_desc = f"T{current_tool} ({tool_names[current_tool]})"
+    tool_number = str(current_tool)
+    for i in range(start, end):
+        line = gcode_lines[i]
+        if not line.startswith(command_starts):
+            continue
+        # Every tool command holds a T or the park's P0; two substring tests are far cheaper than the regex
+        if 'T' not in line and 'P0' not in line:
+            continue
+        # Splices build on each other, so a line with several tool commands gets all of them rewritten;
+        # shift tracks how far the spliced text has moved the offsets of later matches.
+        new_line = line
+        shift = 0
+        for match in find_commands(line):
+            kind = match.lastgroup
+            tool_group = match.lastindex + 1
+            if kind == 'park':
+                if active_tool == current_tool:
+                    gcode_lines[i] = f"; {line} - skipped parking as {tool_desc} is already active"
+                    break
+            elif kind == 'm104':
+                old_tool = int(match.group(tool_group))
+                if old_tool != current_tool:
+                    if active_tool != current_tool:
+                        p_match = p_search(line)
+                        q_match = q_search(line)
+                        s_match = s_search(line)
+                        p_value = p_match.group(1) if p_match else "120"
+                        q_value = q_match.group(1) if q_match else str(int(p_value) + current_tool + 1)
+                        s_value = s_match.group(1) if s_match else "210"
+                        comment_match = comment_search(line)
+                        if comment_match:
+                            comment = comment_match.group(0)
+                        else:
+                            comment = f"; switched from T{old_tool} ({tool_names[old_tool]}) to {tool_desc}"
+                        gcode_lines[i] = f"M104.1 T{current_tool} P{p_value} Q{q_value} S{s_value} {comment}"
+                        active_tool = current_tool
+                    else:
+                        gcode_lines[i] = f"; {line} - skipped as {tool_desc} is already active"
+                        break
+            elif kind == 'tool':
+                old_tool = int(match.group(tool_group))
+                if old_tool != current_tool:
+                    span_start, span_end = match.start(tool_group) + shift, match.end(tool_group) + shift
+                    new_line = gcode_lines[i] = new_line[:span_start] + tool_number + new_line[span_end:]
+                    shift += len(tool_number) - (span_end - span_start)
+                    active_tool = current_tool
+                elif match.group(tool_group + 1, tool_group + 2, tool_group + 3) == ('1', '0', '0'):
+                    # Only skip when nothing on this line was spliced yet (new_line is still line);
+                    # otherwise the line already carries the rewritten pickup and must be kept
+                    if active_tool == current_tool and new_line is line:
+                        gcode_lines[i] = f"; {line} - skipped pickup as {tool_desc} is already active"
+                        break
+                    active_tool = current_tool
+            elif kind == 'simple':
+                old_tool = int(match.group(tool_group))
+                if old_tool != current_tool:
+                    span_start, span_end = match.start(tool_group) + shift, match.end(tool_group) + shift
+                    new_line = gcode_lines[i] = new_line[:span_start] + tool_number + new_line[span_end:]
+                    shift += len(tool_number) - (span_end - span_start)
+                    active_tool = current_tool
+    return active_tool
+
+
+def modify_layer_text(switcher, text, current_tool, active_tool):
+    """Rewrite the tool commands in the text of one layer, splitting it into lines only if it holds any."""
+    # Most layers carry no tool command at all; one cheap search over the layer text rules that
+    # out without walking the lines, and a layer skipped here would not have been changed anyway.
+    if current_tool is None or switcher.tool_hint_pattern.search(text) is None:
+        return text, active_tool
+    lines = text.split('\n')
+    active_tool = modify_range(switcher, lines, 0, len(lines), current_tool, active_tool)
+    return '\n'.join(lines), active_tool
+
+
+def modify_layers(switcher, gcode_blocks, tool_sequence):
+    """Read text in blocks of any size and yield the text of each layer with tool commands rewritten."""
+    find_markers = switcher.layer_pattern.finditer
+    marker_length = len(switcher.layer_markers)
+    layer = -1
+    current_tool = None
+    active_tool = None
+    text = ''
+    search_from = 0
+    for block in gcode_blocks:
+        text += block
+        # One scan over the whole block finds every layer start; the lines in between are never
+        # visited one by one. text always holds the unfinished layer, starting at its marker.
+        layer_start = 0
+        for match in find_markers(text, search_from):
+            start = match.start()
+            if start:
+                chunk, active_tool = modify_layer_text(switcher, text[layer_start:start], current_tool, active_tool)
+                yield chunk
+            layer_start = start
+            layer += 1
+            if layer < len(tool_sequence):
+                current_tool = tool_sequence[layer]
+        text = text[layer_start:]
+        # A marker cut off by the end of the block is found again once the next block is appended;
+        # the marker of the unfinished layer itself sits at offset 0 and must not be counted twice.
+        search_from = max(len(text) - marker_length + 1, 0 if layer < 0 else 1)
+    if text:
+        yield modify_layer_text(switcher, text, current_tool, active_tool)[0]